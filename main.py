@@ -1,15 +1,29 @@
 import argparse
-import math
 import os
-from typing import Optional
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
 
+import numpy as np
 import rasterio
-from rasterio.windows import Window
-from rasterio.windows import transform as window_transform
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
 
 
 DEFAULT_SRC = r"I:\Raster\HyperspectralPixxel2026\v1\FF02_20260106_00501045_0000004144_L2A.tif"
 DEFAULT_GRID = 32
+DEFAULT_GDAL_CACHE_MB = 1024
+LOG_FLUSH_EVERY = 64
+
+_worker_env = None
+_worker_src = None
+_worker_profile = None
+_worker_prefix = None
+_worker_col_offs = None
+_worker_win_ws = None
+_worker_buf = None
+_worker_affine = None
+_worker_writers = None
 
 
 def sanitize_profile(profile: dict) -> dict:
@@ -20,23 +34,261 @@ def sanitize_profile(profile: dict) -> dict:
         p["tiled"] = False
     p.pop("BIGTIFF", None)
     p.pop("bigtiff", None)
+    p["num_threads"] = "ALL_CPUS"
     return p
 
 
+def _progress_logger():
+    count = 0
+
+    def log(line: str) -> None:
+        nonlocal count
+        sys.stdout.write(line)
+        count += 1
+        if count % LOG_FLUSH_EVERY == 0:
+            sys.stdout.flush()
+
+    return log
+
+
+def _plan_grid(
+    h: int, w: int, grid_size: int, patch_w: int, patch_h: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    col_offs = np.arange(grid_size, dtype=np.int64) * patch_w
+    row_offs = np.arange(grid_size, dtype=np.int64) * patch_h
+    win_ws = np.minimum(patch_w, w - col_offs)
+    win_hs = np.minimum(patch_h, h - row_offs)
+    return col_offs, row_offs, win_ws, win_hs
+
+
+def _grid_has_data(full_mask: np.ndarray, grid_size: int, patch_w: int, patch_h: int) -> np.ndarray:
+    h, w = full_mask.shape
+    padded = np.zeros((grid_size * patch_h, grid_size * patch_w), dtype=full_mask.dtype)
+    padded[:h, :w] = full_mask
+    return padded.reshape(grid_size, patch_h, grid_size, patch_w).any(axis=(1, 3))
+
+
+def _coarse_cell_any(src, grid_size: int, patch_w: int, patch_h: int) -> Optional[np.ndarray]:
+    factors = src.overviews(1)
+    if not factors or max(factors) < min(patch_w, patch_h):
+        return None
+    oversample = min(4, patch_w, patch_h)
+    coarse = src.read_masks(
+        1,
+        window=((0, grid_size * patch_h), (0, grid_size * patch_w)),
+        out_shape=(grid_size * oversample, grid_size * oversample),
+        boundless=True,
+    )
+    return coarse.reshape(grid_size, oversample, grid_size, oversample).any(axis=(1, 3))
+
+
+def _write_single_cog(
+    src,
+    out_path: str,
+    full_mask: np.ndarray,
+    cell_any: np.ndarray,
+    grid_size: int,
+    patch_w: int,
+    patch_h: int,
+    log_every: int,
+    no_compress: bool = False,
+) -> int:
+    h, w = src.height, src.width
+
+    profile = src.profile.copy()
+    profile.update(
+        tiled=True,
+        blockxsize=-(-patch_w // 16) * 16,
+        blockysize=-(-patch_h // 16) * 16,
+        compress=None if no_compress else "deflate",
+        num_threads="ALL_CPUS",
+    )
+    if no_compress:
+        for k in ("predictor", "zlevel"):
+            profile.pop(k, None)
+
+    col_offs, row_offs, win_ws, win_hs = _plan_grid(h, w, grid_size, patch_w, patch_h)
+
+    cells = np.argwhere(cell_any)
+    written = 0
+    log = _progress_logger()
+
+    with rasterio.open(out_path, "w", **profile) as dst:
+        for y, x in cells:
+            window = (
+                (row_offs[y], row_offs[y] + win_hs[y]),
+                (col_offs[x], col_offs[x] + win_ws[x]),
+            )
+            dst.write(src.read(window=window), window=window)
+
+            written += 1
+            if log_every and (written % log_every == 0):
+                log(f"  written={written}/{cells.shape[0]} non-empty cells\n")
+
+        dst.write_mask(full_mask)
+
+    sys.stdout.flush()
+    return written
+
+
+def _write_zarr(
+    src,
+    out_path: str,
+    cell_any: np.ndarray,
+    grid_size: int,
+    patch_w: int,
+    patch_h: int,
+    log_every: int,
+) -> int:
+    import zarr
+    from numcodecs import Blosc
+
+    h, w = src.height, src.width
+    bands = src.count
+
+    col_offs, row_offs, win_ws, win_hs = _plan_grid(h, w, grid_size, patch_w, patch_h)
+
+    cells = np.argwhere(cell_any)
+
+    store_kwargs = {}
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        store_kwargs["zarr_format"] = 2
+
+    store = zarr.open(
+        out_path,
+        mode="w",
+        shape=(cells.shape[0], bands, patch_h, patch_w),
+        chunks=(1, bands, patch_h, patch_w),
+        dtype=src.dtypes[0],
+        compressor=Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE),
+        **store_kwargs,
+    )
+
+    coords = []
+    log = _progress_logger()
+
+    for i, (y, x) in enumerate(cells):
+        win_h = int(win_hs[y])
+        win_w = int(win_ws[x])
+
+        row_off = int(row_offs[y])
+        col_off = int(col_offs[x])
+        data = src.read(window=((row_off, row_off + win_h), (col_off, col_off + win_w)))
+
+        if win_h < patch_h or win_w < patch_w:
+            store[i, :, :win_h, :win_w] = data
+        else:
+            store[i] = data
+
+        coords.append([int(x), int(y)])
+
+        if log_every and ((i + 1) % log_every == 0):
+            log(f"  written={i + 1}/{cells.shape[0]} non-empty cells\n")
+
+    sys.stdout.flush()
+
+    store.attrs["cells"] = coords
+    store.attrs["transform"] = list(src.transform)[:6]
+    store.attrs["crs"] = str(src.crs)
+    store.attrs["patch_size"] = [patch_w, patch_h]
+
+    return cells.shape[0]
+
+
+def _init_worker(
+    src_path: str,
+    base_profile: dict,
+    out_dir: str,
+    col_offs: np.ndarray,
+    win_ws: np.ndarray,
+    patch_h: int,
+    gdal_cache_mb: int,
+) -> None:
+    global _worker_env, _worker_src, _worker_profile, _worker_prefix
+    global _worker_col_offs, _worker_win_ws, _worker_buf, _worker_affine, _worker_writers
+    _worker_env = rasterio.Env(GDAL_CACHEMAX=gdal_cache_mb)
+    _worker_env.__enter__()
+    _worker_src = rasterio.open(src_path)
+    _worker_profile = base_profile
+    t = _worker_src.transform
+    _worker_affine = (t.a, t.b, t.c, t.d, t.e, t.f)
+    _worker_prefix = out_dir + os.sep
+    _worker_col_offs = col_offs
+    _worker_win_ws = win_ws
+    _worker_buf = np.empty(
+        (_worker_src.count, patch_h, _worker_src.width), dtype=_worker_src.dtypes[0]
+    )
+    _worker_writers = ThreadPoolExecutor(max_workers=4)
+
+
+def _write_patch(out_path: str, out_profile: dict, data: np.ndarray, mask: np.ndarray) -> None:
+    with MemoryFile() as memfile:
+        with memfile.open(**out_profile) as dst:
+            dst.write(data)
+            dst.write_mask(mask)
+        with open(out_path, "wb") as f:
+            f.write(memfile.read())
+
+
+def _process_row(row: Tuple[int, int, int, Optional[np.ndarray], np.ndarray]) -> int:
+    y, row_off, win_h, strip_mask, xs = row
+    w = _worker_src.width
+
+    strip_window = ((row_off, row_off + win_h), (0, w))
+    if strip_mask is None:
+        strip_mask = _worker_src.dataset_mask(window=strip_window)
+    strip_data = _worker_src.read(window=strip_window, out=_worker_buf[:, :win_h, :])
+
+    a, b, c, d, e, f = _worker_affine
+    row_c = c + row_off * b
+    row_f = f + row_off * e
+
+    futures = []
+
+    for x in xs:
+        col_off = int(_worker_col_offs[x])
+        win_w = int(_worker_win_ws[x])
+
+        mask = strip_mask[:, col_off:col_off + win_w]
+        data = strip_data[:, :, col_off:col_off + win_w]
+
+        out_profile = dict(
+            _worker_profile,
+            height=win_h,
+            width=win_w,
+            transform=Affine(a, b, row_c + col_off * a, d, e, row_f + col_off * d),
+        )
+
+        out_path = f"{_worker_prefix}{x}_{y}.tif"
+        futures.append(_worker_writers.submit(_write_patch, out_path, out_profile, data, mask))
+
+    for fut in futures:
+        fut.result()
+
+    return len(futures)
+
+
 def split_to_patches(
     src_path: str,
     grid_size: int = DEFAULT_GRID,
     out_dir: Optional[str] = None,
     log_every: int = 100,
+    single_cog: bool = False,
+    out_format: str = "gtiff",
+    skip_existing: bool = False,
+    no_compress: bool = False,
+    approx_plan: bool = False,
+    jobs: Optional[int] = None,
+    gdal_cache_mb: int = DEFAULT_GDAL_CACHE_MB,
 ) -> None:
     print(f"[1/6] Opening source GeoTIFF:\n  {src_path}")
 
-    with rasterio.open(src_path) as src:
+    with rasterio.Env(GDAL_CACHEMAX=gdal_cache_mb), rasterio.open(src_path) as src:
         h, w = src.height, src.width
         bands = src.count
 
-        patch_w = math.ceil(w / grid_size)
-        patch_h = math.ceil(h / grid_size)
+        patch_w = -(-w // grid_size)
+        patch_h = -(-h // grid_size)
         total_cells = grid_size * grid_size
 
         print(
@@ -54,71 +306,109 @@ def split_to_patches(
         os.makedirs(out_dir, exist_ok=True)
 
         base_profile = sanitize_profile(src.profile)
+        if no_compress:
+            base_profile["compress"] = None
+            for k in ("predictor", "zlevel"):
+                base_profile.pop(k, None)
 
-        processed = 0
-        written = 0
-        discarded = 0
-
-        print(f"[4/6] Processing {total_cells} grid cells (skipping fully-NoData cells)...")
-
-        for y in range(grid_size):
-            row_off = y * patch_h
-            win_h = min(patch_h, h - row_off)
-            if win_h <= 0:
-                discarded += grid_size - y * grid_size
-                break
-
-            for x in range(grid_size):
-                col_off = x * patch_w
-                win_w = min(patch_w, w - col_off)
-                if win_w <= 0:
-                    discarded += 1
-                    processed += 1
-                    continue
-
-                window = Window(col_off=col_off, row_off=row_off, width=win_w, height=win_h)
-
-                mask = src.dataset_mask(window=window)
-                if mask.max() == 0:
-                    discarded += 1
-                    processed += 1
-                    if log_every and (processed % log_every == 0):
-                        print(
-                            f"  processed={processed}/{total_cells}  "
-                            f"written={written}  discarded={discarded}"
-                        )
-                    continue
-
-                data = src.read(window=window)
-
-                out_profile = base_profile.copy()
-                out_profile.update(
-                    height=win_h,
-                    width=win_w,
-                    transform=window_transform(window, src.transform),
-                )
+        col_offs, row_offs, win_ws, win_hs = _plan_grid(h, w, grid_size, patch_w, patch_h)
+
+        full_mask = None
+        cell_any = None
+        if approx_plan and out_format == "gtiff" and not single_cog:
+            cell_any = _coarse_cell_any(src, grid_size, patch_w, patch_h)
+            if cell_any is not None:
+                cell_any &= (win_hs > 0)[:, None] & (win_ws > 0)[None, :]
+                print("      using overview-backed coarse mask for empty-cell planning")
+        if cell_any is None:
+            full_mask = src.dataset_mask()
+            cell_any = _grid_has_data(full_mask, grid_size, patch_w, patch_h)
+
+        if out_format == "zarr":
+            out_path = os.path.join(out_dir, "patches.zarr")
+            print(f"[4/6] Writing non-empty cells into a single Zarr store:\n  {out_path}")
+            written = _write_zarr(
+                src, out_path, cell_any, grid_size, patch_w, patch_h, log_every
+            )
+            print("[5/6] Done.")
+            print(f"[6/6] Summary:")
+            print(f"  Total grid cells: {total_cells}")
+            print(f"  Written cells:    {written}")
+            print(f"  Discarded (fully NoData): {total_cells - written}")
+            print(f"  Output store: {out_path}")
+            return
+
+        if single_cog:
+            out_path = os.path.join(out_dir, "patches_cog.tif")
+            print(f"[4/6] Writing non-empty cells into a single tiled GeoTIFF:\n  {out_path}")
+            written = _write_single_cog(
+                src, out_path, full_mask, cell_any, grid_size, patch_w, patch_h, log_every,
+                no_compress=no_compress,
+            )
+            print("[5/6] Done.")
+            print(f"[6/6] Summary:")
+            print(f"  Total grid cells: {total_cells}")
+            print(f"  Written cells:    {written}")
+            print(f"  Discarded (fully NoData): {total_cells - written}")
+            print(f"  Output file: {out_path}")
+            return
 
-                out_path = os.path.join(out_dir, f"{x}_{y}.tif")
+    existing = set()
+    if skip_existing:
+        existing = {e.name for e in os.scandir(out_dir) if e.name.endswith(".tif")}
+        print(f"      found {len(existing)} existing patches to skip")
 
-                with rasterio.open(out_path, "w", **out_profile) as dst:
-                    dst.write(data)
-                    dst.write_mask(mask)
+    processed = 0
+    written = 0
+    discarded = 0
+    skipped = 0
 
-                written += 1
-                processed += 1
+    rows = []
+    for y in range(grid_size):
+        row_off = int(row_offs[y])
+        win_h = int(win_hs[y])
+        xs = np.flatnonzero(cell_any[y]) if win_h > 0 else np.empty(0, dtype=np.intp)
+        discarded += grid_size - xs.size
+        if existing and xs.size:
+            keep = np.array([f"{x}_{y}.tif" not in existing for x in xs], dtype=bool)
+            skipped += int(xs.size - keep.sum())
+            xs = xs[keep]
+        if xs.size == 0:
+            processed += grid_size
+            continue
+        strip_mask = full_mask[row_off:row_off + win_h] if full_mask is not None else None
+        rows.append((y, row_off, win_h, strip_mask, xs))
+
+    print(f"[4/6] Processing {total_cells} grid cells (skipping fully-NoData cells)...")
+
+    with ProcessPoolExecutor(
+        max_workers=jobs or os.cpu_count(),
+        initializer=_init_worker,
+        initargs=(src_path, base_profile, out_dir, col_offs, win_ws, patch_h, gdal_cache_mb),
+    ) as executor:
+        log = _progress_logger()
+        log_mark = 0
+        for row_written in executor.map(_process_row, rows, chunksize=1):
+            written += row_written
+            processed += grid_size
+
+            if log_every and (processed // log_every) > log_mark:
+                log_mark = processed // log_every
+                log(
+                    f"  processed={processed}/{total_cells}  "
+                    f"written={written}  discarded={discarded}\n"
+                )
 
-                if log_every and (processed % log_every == 0):
-                    print(
-                        f"  processed={processed}/{total_cells}  "
-                        f"written={written}  discarded={discarded}"
-                    )
+    sys.stdout.flush()
 
-        print("[5/6] Done.")
-        print(f"[6/6] Summary:")
-        print(f"  Total grid cells: {total_cells}")
-        print(f"  Written patches:  {written}")
-        print(f"  Discarded (fully NoData): {discarded}")
-        print(f"  Output folder: {out_dir}")
+    print("[5/6] Done.")
+    print(f"[6/6] Summary:")
+    print(f"  Total grid cells: {total_cells}")
+    print(f"  Written patches:  {written}")
+    print(f"  Discarded (fully NoData): {discarded}")
+    if skip_existing:
+        print(f"  Skipped (already on disk): {skipped}")
+    print(f"  Output folder: {out_dir}")
 
 
 def main() -> None:
@@ -127,6 +417,13 @@ def main() -> None:
     parser.add_argument("--grid-size", type=int, default=DEFAULT_GRID)
     parser.add_argument("--out-dir", default=None)
     parser.add_argument("--log-every", type=int, default=100)
+    parser.add_argument("--single-cog", action="store_true")
+    parser.add_argument("--format", choices=("gtiff", "zarr"), default="gtiff")
+    parser.add_argument("--skip-existing", action="store_true")
+    parser.add_argument("--no-compress", action="store_true")
+    parser.add_argument("--approx-plan", action="store_true")
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--gdal-cache-mb", type=int, default=DEFAULT_GDAL_CACHE_MB)
 
     args = parser.parse_args()
     split_to_patches(
@@ -134,6 +431,13 @@ def main() -> None:
         grid_size=args.grid_size,
         out_dir=args.out_dir,
         log_every=args.log_every,
+        single_cog=args.single_cog,
+        out_format=args.format,
+        skip_existing=args.skip_existing,
+        no_compress=args.no_compress,
+        approx_plan=args.approx_plan,
+        jobs=args.jobs,
+        gdal_cache_mb=args.gdal_cache_mb,
     )
 
 